@@ -1,12 +1,13 @@
 from __future__ import annotations
 
+import copy
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import gradio as gr
-import matplotlib
 import modules.scripts as scripts
 import modules.shared as shared
-import open_clip.tokenizer
 import torch
-from daam import trace
 from ldm.modules.encoders.modules import FrozenOpenCLIPEmbedder
 from modules import (
     script_callbacks,
@@ -19,22 +20,24 @@ from modules.processing import (
     fix_seed,
 )
 from modules.shared import opts
-from transformers.image_transforms import to_pil_image
 
 import webui_daam.log as log
 from webui_daam.image import (
-    create_heatmap_image_overlay,
+    clear_figure_cache,
+    create_heatmap_images_batch,
     compile_processed_image,
+    image_to_background,
 )
 from webui_daam.tokenizer import Tokenizer
 from webui_daam.prompt import PromptAnalyzer
 from webui_daam.grid import GridOpts, GRID_LAYOUT_AUTO
-from webui_daam.heatmap import calc_global_heatmap
-
-matplotlib.use("Agg")
+from webui_daam.heatmap import calc_global_heatmap, iter_heatmaps_on_cpu
 
 addnet_paste_params = {"txt2img": [], "img2img": []}
 
+# Threads rendering the heatmap overlays
+RENDER_WORKERS = min(4, os.cpu_count() or 1)
+
 
 class Script(scripts.Script):
     GRID_LAYOUT_AUTO = "Auto"
@@ -43,6 +46,9 @@ class Script(scripts.Script):
 
     def __init__(self):
         self.trace = None
+        self.enabled = False
+        self._save_pool = None
+        self._render_pool = None
 
     def title(self):
         return "DAAM script"
@@ -201,6 +207,16 @@ class Script(scripts.Script):
         self.heatmap_image_scale = heatmap_image_scale
         self.heatmap_images = dict()
         self.global_heatmaps = []
+        self._analyzer_cache: dict[tuple, PromptAnalyzer] = {}
+
+        # Encoding and writing the heatmap and grid images runs on a
+        # background thread while generation carries on. A single worker
+        # keeps webui's file sequence numbering from racing between our
+        # saves. Saves still pending from the last job are finished first.
+        self.wait_for_saves()
+        self._save_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="daam-save"
+        )
 
         self.attentions = [
             s.strip()
@@ -213,17 +229,22 @@ class Script(scripts.Script):
         fix_seed(p)
 
     def get_tokenizer(self, p):
-        if isinstance(
-            p.sd_model.cond_stage_model.wrapped, FrozenOpenCLIPEmbedder
-        ):
+        wrapped = p.sd_model.cond_stage_model.wrapped
+
+        if isinstance(wrapped, FrozenOpenCLIPEmbedder):
+            import open_clip.tokenizer
+
             return Tokenizer(open_clip.tokenizer._tokenizer.encode)
 
-        if isinstance(p.sd_model.cond_stage_model.weapped, GeneralConditioner):
-            return Tokenizer(p.sd_model.cond_stage_model.wrapped)
+        try:
+            from sgm.modules import GeneralConditioner
 
-        return Tokenizer(
-            p.sd_model.cond_stage_model.wrapped.tokenizer.tokenize
-        )
+            if isinstance(wrapped, GeneralConditioner):
+                return Tokenizer(wrapped)
+        except ModuleNotFoundError:
+            pass
+
+        return Tokenizer(wrapped.tokenizer.tokenize)
 
     def get_context_size(self, p: StableDiffusionProcessing, prompt: str):
         if isinstance(
@@ -245,7 +266,12 @@ class Script(scripts.Script):
                     + "is not supported."
                 )
 
-        prompt_analyzer = PromptAnalyzer(embedders, prompt)
+        key = (tuple(id(embedder) for embedder in embedders), prompt)
+        prompt_analyzer = self._analyzer_cache.get(key)
+        if prompt_analyzer is None:
+            prompt_analyzer = PromptAnalyzer(embedders, prompt)
+            self._analyzer_cache[key] = prompt_analyzer
+
         self.prompt_analyzer = prompt_analyzer
 
         log.debug(
@@ -255,6 +281,25 @@ class Script(scripts.Script):
 
         return prompt_analyzer.context_size
 
+    def get_trace(self, p: StableDiffusionProcessing, context_size: int):
+        # Imported here so loading the extension doesn't pull in daam and
+        # its diffusers/transformers dependencies until DAAM is used
+        from daam import trace
+        from transformers.image_transforms import to_pil_image
+
+        return trace(
+            unet=p.sd_model.model.diffusion_model,
+            vae=p.sd_model.first_stage_model,
+            vae_scale_factor=8,
+            tokenizer=self.prompt_analyzer,
+            width=p.width,
+            height=p.height,
+            context_size=context_size,
+            sample_size=64,  # TODO: Update to proper sample size
+            image_processor=to_pil_image,
+            batch_size=p.batch_size,
+        )
+
     @torch.no_grad()
     def process_batch(
         self,
@@ -294,18 +339,7 @@ class Script(scripts.Script):
 
         # tokenizer = self.get_tokenizer(p)
 
-        self.trace = trace(
-            unet=p.sd_model.model.diffusion_model,
-            vae=p.sd_model.first_stage_model,
-            vae_scale_factor=8,
-            tokenizer=self.prompt_analyzer,
-            width=p.width,
-            height=p.height,
-            context_size=context_size,
-            sample_size=64,  # TODO: Update to proper sample size
-            image_processor=to_pil_image,
-            batch_size=p.batch_size,
-        )
+        self.trace = self.get_trace(p, context_size)
 
         log.info("Trace attention heatmaps for prompt: ")
         log.info(f"\t{styled_prompt}")
@@ -388,36 +422,34 @@ class Script(scripts.Script):
         global_heat_maps = calc_global_heatmap(
             self.trace,
             p.prompts,  # TODO: we should be getting the right prompt here
-            trace_each_layer=self.trace_each_layers,
+            trace_each_layer=trace_each_layers,
             num_input_blocks=num_input_blocks,
             num_output_blocks=num_output_blocks,
         )
 
-        for global_heat_map in global_heat_maps:
+        # The same images are overlaid for every attention and layer
+        backgrounds = [image_to_background(image) for image in images]
+
+        for global_heat_map in iter_heatmaps_on_cpu(global_heat_maps):
             log.debug(
                 f"Global heatmap ({len(global_heat_map.heat_maps)}) "
                 + f"for {global_heat_map.prompts} "
             )
             heatmap_images = []
+            rendered = iter(
+                self.render_heatmap_images(
+                    global_heat_map, images, backgrounds
+                )
+            )
 
-            for image_idx, (image, seed) in enumerate(zip(images, p.seeds)):
+            for _, seed in zip(images, p.seeds):
                 for attention in self.attentions:
-                    log.debug(f"batch_idx {image_idx} attention: {attention}")
-
-                    img = create_heatmap_image_overlay(
-                        global_heat_map,
-                        attention,
-                        image=image,
-                        show_word=self.show_caption,
-                        alpha=self.heatmap_blend_alpha,
-                        batch_idx=image_idx,
-                        opts=opts,
-                    )
+                    img = next(rendered)
 
                     heatmap_images.append(img)
 
                     if self.save_images:
-                        save_image(
+                        self.save_image_in_background(
                             img,
                             p.outpath_samples,
                             "daam",
@@ -489,11 +521,27 @@ class Script(scripts.Script):
 
         log.debug(f"processed images: {processed.images}")
 
-        for (seed, heatmap_images), img in zip(
-            self.heatmap_images.items(), processed.images
+        seeds = list(self.heatmap_images.keys())
+        seed_heatmap_images = list(self.heatmap_images.values())
+        # Skip the webui grid that may precede the generated images
+        generated_images = processed.images[processed.index_of_first_image :]
+
+        if len(generated_images) < len(seeds):
+            log.info(
+                f"Heatmap images for {len(seeds)} seeds but only "
+                + f"{len(generated_images)} generated images"
+            )
+            self.wait_for_saves()
+            return processed
+
+        # Each seed's images go in front of the previous seed's. Collect them
+        # per seed and splice them into the processed lists once at the end.
+        prepended = []
+        prepended_offset = 0
+
+        for seed, heatmap_images, img in zip(
+            seeds, seed_heatmap_images, generated_images
         ):
-            if processed.seed != seed:
-                log.debug(f"INVALID SEED processed {processed.seed} {seed}")
             log.debug(f"Processing seed {seed} ")
             log.debug(f"heatmap_images {heatmap_images}")
             log.debug(f"img {img}")
@@ -529,7 +577,7 @@ class Script(scripts.Script):
                     )
 
                     if save_images:
-                        save_image(
+                        self.save_image_in_background(
                             grid_image,
                             p.outpath_grids,
                             "grid_daam",
@@ -550,10 +598,24 @@ class Script(scripts.Script):
             log.debug(f"Images {images}")
             # debug(f"Infotext {infotexts}")
 
-            # Add new images to the start of the processed image list
-            processed.images[:0] = images
-            processed.index_of_first_image += offset
-            processed.infotexts[:0] = infotexts
+            prepended.append((images, infotexts))
+            prepended_offset += offset
+
+        # Add new images to the start of the processed image list
+        processed.images[:0] = [
+            image
+            for seed_images, _ in reversed(prepended)
+            for image in seed_images
+        ]
+        processed.index_of_first_image += prepended_offset
+        processed.infotexts[:0] = [
+            infotext
+            for _, seed_infotexts in reversed(prepended)
+            for infotext in seed_infotexts
+        ]
+
+        # Finish the saves of this job before webui shows its results
+        self.wait_for_saves()
 
         return processed
 
@@ -577,6 +639,89 @@ class Script(scripts.Script):
         #     }
         # )
 
+    def save_image_in_background(self, image, path, basename, grid, p):
+        """webui's save_image, queued on the save thread. It gets a copy of
+        p taken now, so the file name follows this batch rather than the
+        state p has moved on to by the time the image is written."""
+        # Words whose heatmap couldn't be computed have no image
+        if image is None:
+            return
+
+        if self._save_pool is None:
+            save_image(image, path, basename, grid=grid, p=p)
+            return
+
+        self._save_pool.submit(
+            save_image, image, path, basename, grid=grid, p=copy.copy(p)
+        ).add_done_callback(self.log_save_error)
+
+    @staticmethod
+    def log_save_error(future: Future):
+        err = future.exception()
+        if err is not None:
+            log.warning(err, "DAAM: Failed to save heatmap image")
+
+    def render_heatmap_images(self, global_heat_map, images, backgrounds):
+        """Overlays of every attention for each image, in that order. The
+        attentions of an image are split in runs rendered as one batch."""
+
+        def render(task):
+            image_idx, attentions = task
+            log.debug(f"batch_idx {image_idx} attentions: {attentions}")
+
+            # Grad mode is per thread, the workers don't inherit no_grad
+            with torch.no_grad():
+                return create_heatmap_images_batch(
+                    global_heat_map,
+                    attentions,
+                    image=images[image_idx],
+                    show_word=self.show_caption,
+                    alpha=self.heatmap_blend_alpha,
+                    batch_idx=image_idx,
+                    opts=opts,
+                    background=backgrounds[image_idx],
+                )
+
+        # Enough runs per image to keep the workers busy on a single image
+        run = max(1, -(-len(self.attentions) // RENDER_WORKERS))
+        tasks = [
+            (image_idx, self.attentions[start : start + run])
+            for image_idx in range(len(images))
+            for start in range(0, len(self.attentions), run)
+        ]
+
+        return [
+            img
+            for rendered in self.get_render_pool().map(render, tasks)
+            for img in rendered
+        ]
+
+    def get_render_pool(self):
+        # Kept for the life of the script so the workers, and the figures
+        # they cache, are reused between batches
+        if self._render_pool is None:
+            self._render_pool = ThreadPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                thread_name_prefix="daam-render",
+            )
+
+        return self._render_pool
+
+    def close_render_pool(self):
+        if self._render_pool is None:
+            return
+
+        self._render_pool.shutdown(wait=True)
+        self._render_pool = None
+
+    def wait_for_saves(self):
+        if self._save_pool is None:
+            return
+
+        # Errors are logged as they happen, by log_save_error
+        self._save_pool.shutdown(wait=True)
+        self._save_pool = None
+
     def try_unhook(self):
         if self.trace is not None:
             try:
@@ -586,20 +731,21 @@ class Script(scripts.Script):
             except RuntimeError:
                 pass
 
-    def __getattr__(self, attr):
-        log.warning("unknown call", attr)
-        # import traceback
-        #
-        # traceback.print_stack()
-
 
 def on_script_unloaded():
-    if shared.sd_model:
-        for s in scripts.scripts_txt2img.alwayson_scripts:
+    for runner in (scripts.scripts_txt2img, scripts.scripts_img2img):
+        for s in runner.alwayson_scripts:
             if isinstance(s, Script):
-                s.try_unhook()
+                if shared.sd_model:
+                    s.try_unhook()
+                s.wait_for_saves()
+                s.close_render_pool()
                 break
 
+    # Once the render pools are shut down no thread is left drawing into the
+    # cached figures
+    clear_figure_cache()
+
 
 def on_infotext_pasted(infotext, params):
     pass
@@ -646,3 +792,4 @@ def on_infotext_pasted(infotext, params):
 
 
 script_callbacks.on_infotext_pasted(on_infotext_pasted)
+script_callbacks.on_script_unloaded(on_script_unloaded)
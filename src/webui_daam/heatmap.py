@@ -1,8 +1,13 @@
+from __future__ import annotations
+
 from .log import debug, warning
-from typing import List
+from typing import TYPE_CHECKING, Iterator, List
+
+import torch
 
-from daam.trace import DiffusionHeatMapHooker
-from daam.heatmap import GlobalHeatMap
+if TYPE_CHECKING:
+    from daam.trace import DiffusionHeatMapHooker
+    from daam.heatmap import GlobalHeatMap
 
 
 def calc_global_heatmap(
@@ -33,3 +38,50 @@ def calc_global_heatmap(
         return []
 
     return global_heatmaps
+
+
+def _heat_map_to_cpu(heat_map: torch.Tensor, stream) -> torch.Tensor:
+    if heat_map.is_cuda:
+        # The copy is still queued on the side stream once the caller drops
+        # the device tensor, keep the allocator from reusing it until then
+        heat_map.record_stream(stream)
+
+    return heat_map.to("cpu", non_blocking=True)
+
+
+def _heat_maps_to_cpu(heat_maps, stream):
+    if isinstance(heat_maps, torch.Tensor):
+        return _heat_map_to_cpu(heat_maps, stream)
+
+    return [_heat_map_to_cpu(heat_map, stream) for heat_map in heat_maps]
+
+
+def iter_heatmaps_on_cpu(
+    global_heatmaps: List[GlobalHeatMap],
+) -> Iterator[GlobalHeatMap]:
+    """Yield each global heatmap once its heat maps are on the CPU.
+
+    On CUDA every copy is queued up front on a side stream, so the transfer
+    of the next heatmap overlaps with the overlay work on the current one.
+    """
+    if not torch.cuda.is_available():
+        yield from global_heatmaps
+        return
+
+    stream = torch.cuda.Stream()
+    # The heat maps are produced on the compute stream
+    stream.wait_stream(torch.cuda.current_stream())
+
+    events = []
+    with torch.cuda.stream(stream):
+        for global_heatmap in global_heatmaps:
+            global_heatmap.heat_maps = _heat_maps_to_cpu(
+                global_heatmap.heat_maps, stream
+            )
+            event = torch.cuda.Event()
+            event.record(stream)
+            events.append(event)
+
+    for global_heatmap, event in zip(global_heatmaps, events):
+        event.synchronize()
+        yield global_heatmap
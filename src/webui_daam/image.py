@@ -1,20 +1,62 @@
 import math
+import threading
+from collections import OrderedDict
 # from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib import font_manager
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import torch
-from daam.heatmap import GlobalHeatMap
-from PIL import Image
+import torch.nn.functional as F
+from PIL import Image, ImageDraw, ImageFont
 
 from webui_daam.grid import GridOpts, make_grid
 
 from .log import warning
 
+if TYPE_CHECKING:
+    from daam.heatmap import GlobalHeatMap
+
 matplotlib.use("Agg")
 
+# Figures for the captioned overlays keyed on the rendering thread, their
+# size and colors, reused between calls instead of rebuilt for every word.
+# Each thread only ever draws into its own figures. Least recently used
+# first, capped at _FIG_CACHE_SIZE figures.
+_FIG_CACHE: "OrderedDict[tuple, Figure]" = OrderedDict()
+_FIG_CACHE_LOCK = threading.Lock()
+_FIG_CACHE_SIZE = 8
+
+# Style of the caption figures. Set on their artists rather than through
+# rcParams, which are global to the process and shared with webui.
+_FONT_SIZE = 24
+# matplotlib's "large" at that font size
+_TITLE_SIZE = _FONT_SIZE * 1.2
+
+# Caption font of the overlays, loaded on first use in each thread as
+# FreeType faces aren't safe to share between threads. False when Pillow
+# can't load a TrueType font and captions go through matplotlib instead.
+_CAPTION_FONT = threading.local()
+_CAPTION_SIZE = 24
+_HEADER_SIZE = 40
+
+# Rows blended at a time in blend_heat_map
+_BLEND_ROWS = 64
+
+# Output of the blends done by plot_overlay_heat_map, one per rendering
+# thread, reused while the image size stays the same. Its pixels are copied
+# out before the next blend, by Image.fromarray or imshow.
+_BLEND_OUT = threading.local()
+
+# jet colormap as a 256 entry RGB lookup table
+_JET_LUT = (
+    matplotlib.colormaps["jet"](np.linspace(0, 1, 256))[:, :3] * 255
+).astype(np.uint8)
+
 
 # @dataclass
 # class Opts:
@@ -32,71 +74,69 @@ def plot_overlay_heat_map(
     ax: Optional[plt.Axes] = None,
     alpha: Optional[float] = 1.0,
     opts=None,
+    background: Optional[np.ndarray] = None,
 ):
-    dpi = 100
-    header_size = 40
-    scale = 1.1
+    # swap width/height to match numpy array, shape height, width. Made
+    # contiguous explicitly, on the device when the heatmap lives on the GPU,
+    # so the NumPy passes below walk rows instead of strided columns.
+    heat_np = heat_map.t().contiguous().cpu().numpy()
 
-    if isinstance(im, Image.Image):
-        w = im.size[0]
-        h = im.size[1]
-    elif isinstance(im, torch.Tensor):
-        w = im.size(2)
-        h = im.size(1)
+    if background is None:
+        background = image_to_background(im)
+
+    if crop is not None:
+        heat_np = heat_np[crop:-crop, crop:-crop]
+        background = background[crop:-crop, crop:-crop]
+
+    if not color_normalize:
+        heat_np = np.clip(heat_np, -1, 1)
+
+    # Blend weights that all round to zero leave the image as is
+    if float(heat_np.max()) * alpha * 255 < 0.5:
+        blended = background
     else:
-        raise RuntimeError("Invalid image")
+        heat_rgb = colorize_heat_map(heat_np, color_normalize)
+        blended = blend_heat_map(
+            background, heat_rgb, heat_np, alpha, out=_blend_out(background)
+        )
+
+    return show_overlay(im, blended, word, out_file=out_file, ax=ax, opts=opts)
 
-    width = math.ceil((w / dpi) * scale)
-    height = math.ceil(((h + header_size) / dpi) * scale)
 
+def show_overlay(
+    im: Union[Image.Image, torch.Tensor],
+    blended: np.ndarray,
+    word: Union[None, str] = None,
+    out_file=None,
+    ax: Optional[plt.Axes] = None,
+    opts=None,
+) -> Image.Image:
+    """The blended overlay as is, or as the single image of the captioned
+    figure."""
     if ax is None:
-        plt.clf()
-        plt_ = create_plot_for_img(im, opts)
-    else:
-        plt_ = ax
+        font = caption_font() if word is not None else None
 
-    heat_map = heat_map.permute(1, 0)  # swap width/height to match numpy array
-    # shape height, width
+        if word is None or font is not None:
+            img = Image.fromarray(blended)
 
-    if crop is not None:
-        heat_map = heat_map[crop:-crop, crop:-crop]
-        im = im[crop:-crop, crop:-crop]
+            if word is not None:
+                img = caption_image(img, word, font, opts)
 
-    if color_normalize:
-        plt_.imshow(heat_map.cpu().numpy(), cmap="jet")
-    else:
-        heat_map = heat_map.clamp_(min=-1, max=1)
-        plt_.imshow(heat_map.cpu().numpy(), cmap="jet", vmin=0.0, vmax=1.0)
+            if out_file is not None:
+                img.save(out_file)
 
-    if isinstance(im, Image.Image):
-        im = np.array(im)
-        im = torch.from_numpy(im).float() / 255
-    elif isinstance(im, torch.Tensor):
-        # Tensor comes in channel, width, height to width, height, channel
-        im = im.permute(1, 2, 0)
+            return img
 
-    im = torch.cat((im, (1 - (heat_map.unsqueeze(-1) * alpha))), dim=-1)
+        ax = create_plot_for_img(im, opts)
 
-    plt_.imshow(im)
+    ax.imshow(blended)
 
     if word is not None:
-        if ax is None:
-            plt_.title(word)
-        else:
-            ax.set_title(word)
+        # set_text keeps the styling of the title, set_title would reset it
+        # from the global rcParams
+        ax.title.set_text(word)
 
-    if ax is None:
-        plt_.gcf().set(
-            facecolor=get_opt(opts, "grid_background_color", "#FFF")
-            if opts is not None
-            else "#fff",
-            figwidth=width,
-            figheight=height,
-        )
-
-        img = fig2img(fig=plt_.gcf())
-    else:
-        img = fig2img(fig=plt)
+    img = fig2img(fig=ax.figure)
 
     if out_file is not None:
         img.save(out_file)
@@ -104,14 +144,94 @@ def plot_overlay_heat_map(
     return img
 
 
+def blend_heat_map(
+    background: np.ndarray,
+    heat_rgb: np.ndarray,
+    heat_map: np.ndarray,
+    alpha: float = 1.0,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Blend the colored heatmap over the (height, width, 3) uint8 background.
+
+    Each pixel is weighted by its heat times alpha, the same result as
+    showing the background over the heatmap with 1 - heat * alpha opacity.
+    Written into `out` when given, a uint8 array of the background's shape.
+    """
+    if out is None:
+        out = np.empty(background.shape, dtype=np.uint8)
+
+    # Work through bands of rows so the 16 bit scratch buffers stay small
+    # and cache resident instead of spanning the whole image
+    for y in range(0, out.shape[0], _BLEND_ROWS):
+        rows = slice(y, y + _BLEND_ROWS)
+        _blend_rows(
+            background[rows], heat_rgb[rows], heat_map[rows], alpha, out[rows]
+        )
+
+    return out
+
+
+def _blend_out(background: np.ndarray) -> np.ndarray:
+    out = getattr(_BLEND_OUT, "array", None)
+
+    if out is None or out.shape != background.shape:
+        out = np.empty(background.shape, dtype=np.uint8)
+        _BLEND_OUT.array = out
+
+    return out
+
+
+def _blend_rows(background, heat_rgb, heat_map, alpha, out):
+    # 8 bit weights and 16 bit accumulators instead of float32 images
+    a = np.multiply(heat_map, alpha * 255, dtype=np.float32)
+    np.clip(a, 0, 255, out=a)
+    a += 0.5
+    a8 = a.astype(np.uint16)[..., None]
+
+    acc = background.astype(np.uint16)
+    acc *= 255 - a8
+    acc += heat_rgb * a8
+    # Rounded division by 255
+    acc += 128
+    acc += acc >> 8
+    acc >>= 8
+
+    out[...] = acc
+
+
+def colorize_heat_map(
+    heat_map: np.ndarray, color_normalize: bool = True
+) -> np.ndarray:
+    """Color the (height, width) heatmap with the jet colormap.
+
+    Returns a (height, width, 3) uint8 RGB array. With color_normalize the
+    heatmap is stretched to its own min/max, otherwise values are clipped to
+    [0, 1].
+    """
+    # Scale straight to LUT indices in a single float32 buffer, with the
+    # same binning as matplotlib's colormap lookup
+    if color_normalize:
+        low, high = float(heat_map.min()), float(heat_map.max())
+        scale = 256 / (high - low) if high - low > 1e-8 else 0.0
+        idx = np.subtract(heat_map, low, dtype=np.float32)
+        idx *= scale
+    else:
+        idx = np.multiply(heat_map, 256, dtype=np.float32)
+
+    np.clip(idx, 0, 255, out=idx)
+
+    return _JET_LUT[idx.astype(np.uint8)]
+
+
 def create_heatmap_image_overlay(
-    heatmap: GlobalHeatMap,
+    heatmap: "GlobalHeatMap",
     attention_word: str,
     image: Union[Image.Image, torch.Tensor],
     show_word=True,
     alpha=1.0,
     batch_idx=0,
     opts=None,
+    background: Optional[np.ndarray] = None,
 ):
     try:
         word_heatmap = heatmap.compute_word_heat_map(
@@ -121,19 +241,152 @@ def create_heatmap_image_overlay(
         warning(e, f"Could not compute the word heat map for {attention_word}")
         return
 
+    word = attention_word if show_word else None
+
+    if not heat_map_fired(word_heatmap.value):
+        if background is None:
+            background = image_to_background(image)
+
+        return show_overlay(image, background, word, opts=opts)
+
     img = plot_overlay_heat_map(
         image,
-        word_heatmap.expand_as(image),
-        word=attention_word if show_word else None,
+        expand_heat_map(word_heatmap.value, image),
+        word=word,
         alpha=alpha,
         opts=opts,
+        background=background,
     )
 
     return img
 
 
-def create_plot_for_img(img, opts):
-    plt.clf()
+def heat_map_fired(heat_map: torch.Tensor) -> bool:
+    """Whether the raw word heatmap has any activation to show. A flat map
+    would otherwise be normalized to nothing, and a near flat one would have
+    its noise stretched over the whole colormap."""
+    return float(heat_map.max() - heat_map.min()) >= 1e-6
+
+
+def create_heatmap_images_batch(
+    heatmap: "GlobalHeatMap",
+    attention_words: List[str],
+    image: Union[Image.Image, torch.Tensor],
+    show_word=True,
+    alpha=1.0,
+    batch_idx=0,
+    opts=None,
+    background: Optional[np.ndarray] = None,
+) -> List[Optional[Image.Image]]:
+    """create_heatmap_image_overlay for several words over the same image.
+    The word heatmaps are resampled together and leave the device in one
+    copy. Words that fail to compute give None in their place."""
+    images: List[Optional[Image.Image]] = [None] * len(attention_words)
+    heat_maps = []
+    found = []
+
+    if background is None:
+        background = image_to_background(image)
+
+    for i, attention_word in enumerate(attention_words):
+        try:
+            word_heatmap = heatmap.compute_word_heat_map(
+                word=attention_word, batch_idx=batch_idx
+            )
+        except ValueError as e:
+            warning(
+                e, f"Could not compute the word heat map for {attention_word}"
+            )
+            continue
+
+        if not heat_map_fired(word_heatmap.value):
+            images[i] = show_overlay(
+                image,
+                background,
+                attention_word if show_word else None,
+                opts=opts,
+            )
+            continue
+
+        heat_maps.append(word_heatmap.value)
+        found.append(i)
+
+    if not heat_maps:
+        return images
+
+    # (words, height, width) rows for the NumPy side, transposed on the
+    # device so each frame's .t() below is a view plot_overlay_heat_map
+    # transposes back without a copy
+    frames = (
+        expand_heat_maps(torch.stack(heat_maps), image)
+        .transpose(1, 2)
+        .contiguous()
+        .cpu()
+    )
+
+    for i, frame in zip(found, frames):
+        images[i] = plot_overlay_heat_map(
+            image,
+            frame.t(),
+            word=attention_words[i] if show_word else None,
+            alpha=alpha,
+            opts=opts,
+            background=background,
+        )
+
+    return images
+
+
+def expand_heat_map(
+    heat_map: torch.Tensor, image: Union[Image.Image, torch.Tensor]
+) -> torch.Tensor:
+    """Resample the heatmap to the image, normalized to 0..1, in the (width,
+    height) layout of WordHeatMap.expand_as. Unlike expand_as this stays on
+    the heatmap's device and also takes tensor images."""
+    return expand_heat_maps(heat_map[None], image)[0]
+
+
+def expand_heat_maps(
+    heat_maps: torch.Tensor, image: Union[Image.Image, torch.Tensor]
+) -> torch.Tensor:
+    """expand_heat_map for a (N, h, w) stack, each normalized on its own."""
+    if isinstance(image, Image.Image):
+        size = image.size
+    elif isinstance(image, torch.Tensor):
+        size = (image.size(2), image.size(1))
+    else:
+        raise RuntimeError("Invalid image")
+
+    im = F.interpolate(
+        heat_maps.detach()[:, None].float(), size=size, mode="bicubic"
+    )[:, 0]
+
+    low = im.amin(dim=(1, 2), keepdim=True)
+    high = im.amax(dim=(1, 2), keepdim=True)
+    return (im - low).div_(high - low + 1e-8)
+
+
+def image_to_background(im: Union[Image.Image, torch.Tensor]) -> np.ndarray:
+    """Convert the image to the (height, width, 3) uint8 array the heatmap is
+    blended over. Convert once and pass it as `background` when overlaying
+    several heatmaps on the same image."""
+    if isinstance(im, Image.Image):
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        # Wraps the buffer PIL exports instead of copying it once more. The
+        # array is read-only, the background is only ever read from.
+        return np.asarray(im)
+    elif isinstance(im, torch.Tensor):
+        # Tensor comes in channel, width, height to width, height, channel
+        im = im.permute(1, 2, 0).clamp(0, 1) * 255
+        # The permuted layout survives the elementwise ops, copy it into
+        # rows before leaving the device
+        return im.round().to(torch.uint8).contiguous().cpu().numpy()
+
+    raise RuntimeError("Invalid image")
+
+
+def create_plot_for_img(img, opts) -> plt.Axes:
     dpi = 100
     header_size = 40
     scale = 1.1
@@ -142,7 +395,7 @@ def create_plot_for_img(img, opts):
         w = img.size[0]
         h = img.size[1]
     elif isinstance(img, torch.Tensor):
-        w = img.size(0)
+        w = img.size(2)
         h = img.size(1)
     else:
         raise RuntimeError("Invalid image")
@@ -150,43 +403,123 @@ def create_plot_for_img(img, opts):
     width = math.ceil((w / dpi) * scale)
     height = math.ceil(((h + header_size) / dpi) * scale)
 
-    plt.tight_layout()
-    plt.rcParams.update(
-        {
-            "font.size": 24,
-            "figure.figsize": (width, height),
-            "figure.dpi": dpi,
-            "savefig.bbox": "tight",
-            "savefig.pad_inches": 0,
-            "figure.frameon": False,
-            "axes.spines.left": False,
-            "axes.spines.right": False,
-            "axes.spines.top": False,
-            "axes.spines.bottom": False,
-            "ytick.major.left": False,
-            "ytick.major.right": False,
-            "ytick.minor.left": False,
-            "xtick.major.top": False,
-            "xtick.major.bottom": False,
-            "xtick.minor.top": False,
-            "xtick.minor.bottom": False,
-        }
+    background_color, text_color = caption_colors(opts)
+
+    key = (
+        threading.get_ident(),
+        width,
+        height,
+        dpi,
+        background_color,
+        text_color,
     )
 
-    if opts is not None:
-        plt.rcParams.update(
-            {
-                "text.color": get_opt(opts, "grid_text_active_color", "#000"),
-                "axes.labelcolor": get_opt(
-                    opts, "grid_background_color", "#FFF"
-                ),
-                "figure.facecolor": get_opt(
-                    opts, "grid_background_color", "#FFF"
-                ),
-            }
-        )
+    with _FIG_CACHE_LOCK:
+        fig = _FIG_CACHE.get(key)
+        if fig is not None:
+            _FIG_CACHE.move_to_end(key)
+
+    if fig is not None:
+        ax = fig.axes[0]
+        # Drop the previous overlay, the styling of the axes is kept
+        for image in list(ax.images):
+            image.remove()
+        ax.title.set_text("")
+        return ax
+
+    fig = Figure(figsize=(width, height), dpi=dpi, facecolor=background_color)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.tick_params(
+        which="both",
+        left=False,
+        right=False,
+        top=False,
+        bottom=False,
+        labelsize=_FONT_SIZE,
+    )
+    ax.xaxis.label.set_color(background_color)
+    ax.yaxis.label.set_color(background_color)
+    ax.title.set_fontsize(_TITLE_SIZE)
+    ax.title.set_color(text_color)
+
+    with _FIG_CACHE_LOCK:
+        _FIG_CACHE[key] = fig
+
+        while len(_FIG_CACHE) > _FIG_CACHE_SIZE:
+            (thread, *_), evicted = _FIG_CACHE.popitem(last=False)
+            # Another thread may still be drawing into its figure, leave it
+            # to be collected once that thread lets go of it
+            if thread == key[0]:
+                _release_figure(evicted)
+
+    return ax
+
+
+def clear_figure_cache():
+    """Release the cached caption figures."""
+    with _FIG_CACHE_LOCK:
+        while _FIG_CACHE:
+            _release_figure(_FIG_CACHE.popitem()[1])
 
-    return plt
+
+def _release_figure(fig: Figure):
+    # The figures are never registered with pyplot, so plt.close has nothing
+    # to close. Clearing drops the axes with the overlay image, which makes
+    # up most of their memory, even while something still references it.
+    fig.clear()
+
+
+def caption_colors(opts) -> Tuple[str, str]:
+    """Background and text colors of the captions, from the grid options."""
+    if opts is None:
+        return "#FFF", "#000"
+
+    return (
+        get_opt(opts, "grid_background_color", "#FFF"),
+        get_opt(opts, "grid_text_active_color", "#000"),
+    )
+
+
+def caption_font() -> Optional[ImageFont.FreeTypeFont]:
+    font = getattr(_CAPTION_FONT, "font", None)
+
+    if font is None:
+        try:
+            font = ImageFont.truetype(
+                font_manager.findfont("DejaVu Sans"), _CAPTION_SIZE
+            )
+        except (ImportError, OSError):
+            font = False
+
+        _CAPTION_FONT.font = font
+
+    return font or None
+
+
+def caption_image(
+    img: Image.Image, word: str, font: ImageFont.FreeTypeFont, opts=None
+) -> Image.Image:
+    """The image below a header with the word centered in it."""
+    background_color, text_color = caption_colors(opts)
+
+    captioned = Image.new(
+        "RGB", (img.width, img.height + _HEADER_SIZE), background_color
+    )
+    captioned.paste(img, (0, _HEADER_SIZE))
+
+    ImageDraw.Draw(captioned).text(
+        (img.width / 2, _HEADER_SIZE / 2),
+        word,
+        fill=text_color,
+        font=font,
+        anchor="mm",
+    )
+
+    return captioned
 
 
 def get_opt(opts, opt, default):
@@ -202,13 +535,25 @@ def get_opt(opts, opt, default):
 # Get the PIL image from a plot figure or the current plot
 def fig2img(fig):
     """Convert a Matplotlib figure to a PIL Image and return it"""
-    import io
+    canvas = fig.canvas
+    if not isinstance(canvas, FigureCanvasAgg):
+        canvas = FigureCanvasAgg(fig)
 
-    buf = io.BytesIO()
-    fig.savefig(buf)
-    buf.seek(0)
-    img = Image.open(buf)
-    return img
+    canvas.draw()
+
+    # Crop to the drawn content like savefig with a tight bbox and no
+    # padding did. The bbox is in inches from the bottom left corner. Its
+    # size is truncated to whole pixels, as Agg sizes the savefig canvas.
+    buf = np.asarray(canvas.buffer_rgba())
+    height, width = buf.shape[:2]
+    x0, y0, x1, y1 = fig.get_tightbbox(canvas.get_renderer()).extents
+    left = max(math.floor(x0 * fig.dpi), 0)
+    right = min(left + int((x1 - x0) * fig.dpi), width)
+    top = max(math.floor(height - y1 * fig.dpi), 0)
+    bottom = min(top + int((y1 - y0) * fig.dpi), height)
+
+    # Copy the pixels out, the figure and its buffer get reused
+    return Image.fromarray(buf[top:bottom, left:right].copy())
 
 
 def compile_processed_image(
@@ -240,9 +585,10 @@ def compile_processed_image(
 
     # ORIGINAL IMAGES
 
-    if use_grid:
+    # Without heatmaps there is nothing to grid with the image
+    if use_grid and heatmap_images:
         img_heatmap_grid_img = make_grid(
-            heatmap_images + [image], opts=grid_opts
+            (*heatmap_images, image), opts=grid_opts
         )
 
         grid_images_list.append(img_heatmap_grid_img)
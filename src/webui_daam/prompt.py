@@ -10,6 +10,9 @@ from modules.sd_hijack_open_clip import (
 )
 from modules.shared import opts
 
+_ESCAPE_PAREN_RE = re.compile(r"[()\[\]]")
+_ESCAPE_WEIGHT_RE = re.compile(r":\d+\.*\d*")
+
 
 def calc_context_size(token_length: int):
     len_check = 0 if (token_length - 1) < 0 else token_length - 1
@@ -21,15 +24,18 @@ Prompts = TypeVar("Prompts", List[str], str)
 
 def escape_prompt(prompt: Prompts) -> Prompts:
     if isinstance(prompt, str):
-        prompt = prompt.lower()
-        prompt = re.sub(r"[\(\)\[\]]", "", prompt)
-        prompt = re.sub(r":\d+\.*\d*", "", prompt)
-        return prompt
+        prompt = _ESCAPE_PAREN_RE.sub("", prompt.lower())
+        return _ESCAPE_WEIGHT_RE.sub("", prompt)
     elif isinstance(prompt, list):
-        prompt_new = []
-        for i in range(len(prompt)):
-            prompt_new.append(escape_prompt(prompt[i]))
-        return prompt_new
+        return [escape_prompt(p) for p in prompt]
+
+
+def _copy_tokens(tokens):
+    """Copy token lists so callers can't modify the cached ones."""
+    if isinstance(tokens, list):
+        return [_copy_tokens(t) for t in tokens]
+
+    return tokens
 
 
 TPromptAnalyzer = TypeVar("TPromptAnalyzer", bound="PromptAnalyzer")
@@ -52,6 +58,11 @@ class PromptAnalyzer:
 
         self.embedders = embedders
 
+        # The trace tokenizes the same prompt and attention words for every
+        # word heatmap, keep the results keyed on the raw text
+        self._tokenize_line_cache = {}
+        self._tokenize_cache = {}
+
         _chunks, token_count = self.tokenize_line(text)
         self.context_size = calc_context_size(token_count)
         self.token_count = token_count
@@ -60,20 +71,31 @@ class PromptAnalyzer:
         return PromptAnalyzer(self.conditioner, text)
 
     def tokenize_line(self, line) -> Tuple[PromptChunk, int]:
+        if line in self._tokenize_line_cache:
+            return self._tokenize_line_cache[line]
+
         for embedder in [
             embedder
             for embedder in self.embedders
             if hasattr(embedder, "tokenize_line")
         ]:
-            return embedder.tokenize_line(line)
+            result = embedder.tokenize_line(line)
+            self._tokenize_line_cache[line] = result
+            return result
 
     def tokenize(self, texts):
+        key = texts if isinstance(texts, str) else tuple(texts)
+        if key in self._tokenize_cache:
+            return _copy_tokens(self._tokenize_cache[key])
+
         for embedder in [
             embedder
             for embedder in self.embedders
             if hasattr(embedder, "tokenize")
         ]:
-            return embedder.tokenize(texts)
+            tokens = embedder.tokenize(texts)
+            self._tokenize_cache[key] = _copy_tokens(tokens)
+            return tokens
 
     def process_text(self, texts: List[str]):
         for embedder in [
@@ -1,8 +1,10 @@
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 import pytest
 import torch
 from daam.heatmap import GlobalHeatMap
@@ -10,8 +12,15 @@ from PIL import Image
 from webui_daam.image import (
     plot_overlay_heat_map,
     create_heatmap_image_overlay,
+    create_heatmap_images_batch,
     compile_processed_image,
     add_to_start,
+    blend_heat_map,
+    clear_figure_cache,
+    colorize_heat_map,
+    create_plot_for_img,
+    expand_heat_map,
+    image_to_background,
 )
 from webui_daam.grid import GridOpts, GRID_LAYOUT_AUTO
 
@@ -75,6 +84,13 @@ def test_crop_parameter_none(sample_image, sample_heat_map):
     assert isinstance(img, Image.Image)
 
 
+def test_crop_parameter(sample_image, sample_heat_map):
+    # Test cropping both the heatmap and the read-only background
+    img = plot_overlay_heat_map(sample_image, sample_heat_map, crop=10)
+
+    assert img.size == (80, 80)
+
+
 def test_color_normalize_true(sample_image, sample_heat_map):
     # Test with color_normalize=True
     img = plot_overlay_heat_map(
@@ -93,6 +109,113 @@ def test_color_normalize_false(sample_image, sample_heat_map):
     assert isinstance(img, Image.Image)
 
 
+def test_fast_path_keeps_image_size(sample_image, sample_heat_map):
+    # Without a word or axes the overlay is blended without matplotlib
+    img = plot_overlay_heat_map(sample_image, sample_heat_map)
+
+    assert img.size == sample_image.size
+
+
+def test_blend_heat_map():
+    background = np.full((2, 2, 3), 200, dtype=np.uint8)
+    heat_rgb = np.zeros((2, 2, 3), dtype=np.uint8)
+    heat_map = np.array([[0.0, 1.0], [0.5, 2.0]], dtype=np.float32)
+
+    out = blend_heat_map(background, heat_rgb, heat_map, alpha=1.0)
+
+    assert out.dtype == np.uint8
+    assert out[0, 0, 0] == 200  # no heat shows the background
+    assert out[0, 1, 0] == 0  # full heat shows the heatmap
+    assert out[1, 0, 0] == 100
+    assert out[1, 1, 0] == 0  # heat is clipped to 1
+
+
+def test_reused_blend_output_keeps_earlier_images(sample_image):
+    # Test overlays made one after the other through the same buffer
+    first = plot_overlay_heat_map(sample_image, torch.rand((100, 100)))
+    pixels = np.asarray(first).copy()
+
+    plot_overlay_heat_map(sample_image, torch.rand((100, 100)))
+
+    assert np.array_equal(np.asarray(first), pixels)
+
+
+def test_blend_heat_map_matches_float_blend():
+    # Taller than one band of rows
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 256, (150, 20, 3), dtype=np.uint8)
+    heat_rgb = rng.integers(0, 256, (150, 20, 3), dtype=np.uint8)
+    heat_map = rng.random((150, 20), dtype=np.float32)
+
+    out = blend_heat_map(background, heat_rgb, heat_map, alpha=0.5)
+
+    a = np.clip(heat_map * 0.5, 0, 1)[..., None]
+    expected = background * (1 - a) + heat_rgb * a
+    assert out.shape == background.shape
+    assert np.abs(out - expected).max() <= 1
+
+
+def test_colorize_heat_map(sample_heat_map):
+    rgb = colorize_heat_map(sample_heat_map.numpy())
+
+    assert rgb.shape == (100, 100, 3)
+    assert rgb.dtype == np.uint8
+
+
+def test_colorize_heat_map_matches_jet():
+    heat_map = np.linspace(0, 1, 11).reshape(1, 11)
+    rgb = colorize_heat_map(heat_map, color_normalize=False)
+
+    expected = plt.get_cmap("jet")(heat_map)[..., :3] * 255
+    assert np.abs(rgb.astype(np.float64) - expected).max() < 1
+
+
+def test_colorize_heat_map_flat():
+    # A flat heatmap can't be normalized, it maps to the lowest color
+    rgb = colorize_heat_map(np.full((4, 4), 0.5, dtype=np.float32))
+
+    assert (rgb == rgb[0, 0]).all()
+
+
+def test_create_plot_for_img_reuses_figure(sample_image, sample_heat_map):
+    ax = create_plot_for_img(sample_image, None)
+    ax.imshow(sample_heat_map.numpy())
+    ax.title.set_text("TestWord")
+
+    reused_ax = create_plot_for_img(sample_image, None)
+
+    assert reused_ax is ax
+    assert len(reused_ax.images) == 0
+    assert reused_ax.get_title() == ""
+
+
+def test_create_plot_for_img_per_thread(sample_image):
+    ax = create_plot_for_img(sample_image, None)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        thread_ax = pool.submit(create_plot_for_img, sample_image, None)
+
+    assert thread_ax.result() is not ax
+
+
+def test_figure_cache_evicts_least_recent():
+    first = Image.new("RGB", (100, 100))
+    ax = create_plot_for_img(first, None)
+
+    for size in range(2, 20):
+        create_plot_for_img(Image.new("RGB", (size * 100, 100)), None)
+
+    assert create_plot_for_img(first, None) is not ax
+
+
+def test_clear_figure_cache(sample_image):
+    ax = create_plot_for_img(sample_image, None)
+
+    clear_figure_cache()
+
+    assert create_plot_for_img(sample_image, None) is not ax
+
+
 def test_axis_parameter(sample_image, sample_heat_map):
     # Test with a specified axis
     fig, ax = plt.subplots()
@@ -102,6 +225,24 @@ def test_axis_parameter(sample_image, sample_heat_map):
     assert isinstance(img, Image.Image)
 
 
+def test_axis_parameter_single_image(sample_image, sample_heat_map):
+    fig, ax = plt.subplots()
+    plot_overlay_heat_map(sample_image, sample_heat_map, ax=ax)
+    assert len(ax.images) == 1
+    plt.close(fig)
+
+
+def test_axis_parameter_cropped_to_content(sample_image, sample_heat_map):
+    # Test the figure margins are cropped off like savefig's tight bbox
+    fig, ax = plt.subplots()
+    img = plot_overlay_heat_map(sample_image, sample_heat_map, ax=ax)
+
+    width, height = fig.canvas.get_width_height()
+    assert img.width < width
+    assert img.height < height
+    plt.close(fig)
+
+
 def test_alpha_parameter(sample_image, sample_heat_map):
     # Test with different alpha values
 
@@ -110,6 +251,55 @@ def test_alpha_parameter(sample_image, sample_heat_map):
     assert isinstance(img, Image.Image)
 
 
+def test_expand_heat_map(sample_image):
+    heat_map = torch.rand((16, 16))
+
+    expanded = expand_heat_map(heat_map, sample_image)
+
+    assert expanded.shape == sample_image.size
+    assert expanded.min() >= 0
+    assert expanded.max() <= 1
+
+
+def test_expand_heat_map_tensor_image():
+    expanded = expand_heat_map(torch.rand((16, 16)), torch.rand(3, 20, 30))
+
+    assert expanded.shape == (30, 20)
+
+
+def test_image_to_background_tensor_is_contiguous():
+    background = image_to_background(torch.rand(3, 20, 30))
+
+    assert background.shape == (20, 30, 3)
+    assert background.flags["C_CONTIGUOUS"]
+
+
+def test_empty_heat_map_keeps_image():
+    image = Image.new("RGB", (100, 100), color="red")
+
+    img = plot_overlay_heat_map(image, torch.zeros((100, 100)))
+
+    assert np.array_equal(np.asarray(img), np.asarray(image))
+
+
+def test_word_caption_header(sample_image, sample_heat_map):
+    # Test the caption is drawn in a header above the overlay
+    img = plot_overlay_heat_map(sample_image, sample_heat_map, word="word")
+
+    assert img.size == (100, 140)
+
+
+def test_background_parameter(sample_image, sample_heat_map):
+    # Test with a precomputed background
+    background = image_to_background(sample_image)
+    img = plot_overlay_heat_map(
+        sample_image, sample_heat_map, background=background
+    )
+
+    assert background.shape == (100, 100, 3)
+    assert isinstance(img, Image.Image)
+
+
 def test_basic_global_heatmap_functionality(
     sample_global_heatmap, sample_image
 ):
@@ -139,6 +329,58 @@ def test_show_word_false(sample_global_heatmap, sample_image):
     assert isinstance(img, Image.Image)
 
 
+def test_create_heatmap_images_batch(sample_global_heatmap, sample_image):
+    # Test batching matches the overlays made one word at a time
+    images = create_heatmap_images_batch(
+        sample_global_heatmap, ["word", "test"], sample_image, show_word=False
+    )
+
+    assert len(images) == 2
+    for word, img in zip(["word", "test"], images):
+        expected = create_heatmap_image_overlay(
+            sample_global_heatmap, word, sample_image, show_word=False
+        )
+        assert np.array_equal(np.asarray(img), np.asarray(expected))
+
+
+def test_create_heatmap_images_batch_missing_word(
+    sample_global_heatmap, sample_image
+):
+    # Test a word not in the prompt keeps its place as None
+    images = create_heatmap_images_batch(
+        sample_global_heatmap, ["missing", "word"], sample_image
+    )
+
+    assert images[0] is None
+    assert isinstance(images[1], Image.Image)
+
+
+@pytest.mark.parametrize(
+    "heat_maps",
+    [torch.zeros((4, 5, 5)), torch.full((4, 5, 5), 0.5)],
+)
+def test_word_that_did_not_fire_keeps_image(heat_maps):
+    # Test flat raw heatmaps keep the image instead of being normalized
+    def tokenizer(x):
+        return x.split()
+
+    prompts = ["Test prompt word", "word prompt test"]
+    global_heatmap = GlobalHeatMap(
+        Tokenizer(tokenizer), prompts, [heat_maps] * 2
+    )
+    image = Image.new("RGB", (100, 100), color="red")
+
+    img = create_heatmap_image_overlay(
+        global_heatmap, "word", image, show_word=False
+    )
+    (batch_img,) = create_heatmap_images_batch(
+        global_heatmap, ["word"], image, show_word=False
+    )
+
+    assert np.array_equal(np.asarray(img), np.asarray(image))
+    assert np.array_equal(np.asarray(batch_img), np.asarray(image))
+
+
 def test_global_heatmap_alpha_parameter(sample_global_heatmap, sample_image):
     # Test with different alpha values
     img = create_heatmap_image_overlay(
@@ -269,6 +511,24 @@ def test_compile_processed_image_use_grid_per_image(
     assert len(grid_images) == 1
 
 
+def test_compile_processed_image_use_grid_no_heatmaps(
+    sample_image, sample_infotexts, sample_grid_opts
+):
+    # Test compile_processed_image with use_grid=True and no heatmap images
+    images, infotexts, offset, grid_images = compile_processed_image(
+        sample_image,
+        [],
+        sample_infotexts[0],
+        0,
+        sample_grid_opts,
+        use_grid=True,
+    )
+    assert images == []
+    assert infotexts == []
+    assert offset == 0
+    assert grid_images == []
+
+
 # ADD TO START
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
@@ -346,3 +606,4 @@ def test_add_to_start_offset(sample_images):
     assert images == [sample_images[0]]
     assert infotexts == ["new_infotext"]
     assert offset == 3
+